@@ -1,11 +1,45 @@
-import streamlit as st
-import google.generativeai as genai
+import asyncio
+import collections
+import concurrent.futures
+import logging
 import os
-from dotenv import load_dotenv
+import re
+import threading
+import time
+import types
+import uuid
+
+import streamlit as st
 
+logger = logging.getLogger(__name__)
+
+# Read-only so the shared settings can't be mutated between model builds.
+GENERATION_CONFIG = types.MappingProxyType({
+    "temperature": 0.7,
+    "top_p": 1.0,
+    "top_k": 32,
+    "max_output_tokens": 2048,
+})
+SAFETY_SETTINGS = tuple(
+    types.MappingProxyType({"category": category, "threshold": "BLOCK_MEDIUM_AND_ABOVE"})
+    for category in (
+        "HARM_CATEGORY_HARASSMENT",
+        "HARM_CATEGORY_HATE_SPEECH",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_DANGEROUS_CONTENT",
+    )
+)
 
-# load_dotenv("fun_load2.env") 
-API_KEY = st.secrets["GOOGLE_API_KEY"]
+STREAM_FLUSH_INTERVAL = 0.016  # seconds, roughly one frame at 60fps
+ASYNC_CALL_TIMEOUT = 60  # seconds to wait for a Gemini request or the next streamed chunk
+MAX_MESSAGES = 50  # messages kept on screen
+MAX_HISTORY = 100  # history entries sent back to Gemini as context
+# Finish reasons the SDK accepts into chat history; anything else (SAFETY, RECITATION, ...) is a stopped reply.
+COMPLETE_FINISH_REASONS = frozenset({"FINISH_REASON_UNSPECIFIED", "STOP", "MAX_TOKENS"})
+API_ERROR_PATTERN = re.compile(
+    r"(?P<auth>API[_ ]?KEY|PERMISSION_DENIED|UNAUTHENTICATED)|(?P<quota>RESOURCE_EXHAUSTED)",
+    re.IGNORECASE,
+)
 
 # --- Page Configuration (must be the first Streamlit command) ---
 st.set_page_config(
@@ -15,62 +49,153 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
+def get_api_key():
+    """Returns the Gemini API key from Streamlit secrets, the environment, or the sidebar."""
+    # Reading `st.secrets` without a secrets.toml draws a "No secrets files found" error, so check first.
+    if st.secrets.load_if_toml_exists() and "GOOGLE_API_KEY" in st.secrets:
+        return st.secrets["GOOGLE_API_KEY"]
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if api_key:
+        return api_key
+    return st.sidebar.text_input("Google API Key", type="password")
+
+@st.cache_resource
 def configure_api(api_key_to_configure):
-    """Configures the Gemini API with the provided key."""
+    """Configures the Gemini API with the provided key, once per distinct key."""
     try:
+        import google.generativeai as genai
+
         genai.configure(api_key=api_key_to_configure)
         return True
     except Exception as e:
         
         return False
 
-def initialize_gemini_model(model_name="models/gemini-1.5-flash-latest"):
+@st.cache_resource
+def get_event_loop():
+    """Starts one background asyncio loop shared by all sessions for async Gemini calls."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro, timeout=ASYNC_CALL_TIMEOUT):
+    """Runs a coroutine on the shared event loop and waits for its result.
+
+    Streamlit can't interrupt a script thread blocked here, so a call that stalls is cancelled after `timeout` seconds.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise TimeoutError(f"No response from Gemini within {timeout} seconds.") from None
+
+def iter_async(async_iterable):
+    """Iterates an async iterable from synchronous code, e.g. for `st.write_stream`."""
+    iterator = async_iterable.__aiter__()
+
+    async def next_item():
+        return await iterator.__anext__()
+
+    while True:
+        try:
+            yield run_async(next_item())
+        except StopAsyncIteration:
+            return
+
+@st.cache_resource
+def get_gemini_model(api_key, model_name="models/gemini-1.5-flash-latest"):
+    """Builds the Gemini model for one API key once and shares it across sessions and reruns.
+
+    `genai.configure()` is process-wide, so the model gets its own client bound to `api_key` instead of
+    picking up whichever key another session configured last when it sends its first request.
+    """
+    import google.ai.generativelanguage as glm
+    import google.generativeai as genai
+
+    async def new_async_client():
+        # Created on the shared loop, which the async gRPC channel is tied to.
+        return glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+
+    logger.info("Initializing Gemini model: %s", model_name)
+    model = genai.GenerativeModel(
+        model_name=model_name,
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS
+    )
+    model._async_client = run_async(new_async_client())
+    return model
+
+@st.cache_resource(max_entries=100)
+def get_chat_session(session_id, api_key, model_name="models/gemini-1.5-flash-latest"):
+    """Starts one chat per session id, so it survives reruns and page reloads.
+
+    Returned with the lock that serializes its use, since tabs sharing a session id would otherwise
+    race on it; caching them together means they are always evicted together.
+    """
+    return get_gemini_model(api_key, model_name).start_chat(history=[]), threading.Lock()
+
+def read_chat_history(chat_session):
+    """Returns the chat history, first dropping a reply that never finished cleanly.
+
+    `ChatSession.history` raises while such a reply is pending, and every later message would fail with it.
+    """
+    from google.generativeai.types import generation_types
+
+    try:
+        return chat_session.history
+    except generation_types.IncompleteIterationError:
+        # `rewind()` reads the finished reply, so let the abandoned stream run out first;
+        # if it fails, the error is recorded on the response and rewind() still works.
+        try:
+            run_async(chat_session.last.resolve())
+        except Exception:
+            pass
+    except generation_types.BrokenResponseError:
+        pass
+    chat_session.rewind()
+    return chat_session.history
+
+def content_text(content):
+    """Returns the text of a chat history entry."""
+    return "".join(part.text for part in content.parts)
+
+def initialize_gemini_model(api_key, model_name="models/gemini-1.5-flash-latest"):
     """Initializes the Gemini model."""
-    st.write(f"Attempting to initialize model: {model_name}")
     try:
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 1.0,
-            "top_k": 32,
-            "max_output_tokens": 2048,
-        }
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        ]
-        model = genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
-        return model
+        return get_gemini_model(api_key, model_name)
     except Exception as e:
         st.error(f"Error initializing model '{model_name}': {e}")
-        st.error("This might be due to an invalid API key (check `fun_load2.env`), network issues, or the model not being available. "
+        st.error("This might be due to an invalid API key, network issues, or the model not being available. "
                  "Try updating `google-generativeai` (`pip install --upgrade google-generativeai`).")
         return None
 
 
 if 'api_configured' not in st.session_state:
     st.session_state.api_configured = False
-if 'attempted_initial_config' not in st.session_state: 
-    st.session_state.attempted_initial_config = False
+if 'session_id' not in st.session_state:
+    # Kept in the URL so a page reload picks up the same cached chat.
+    st.session_state.session_id = st.query_params.get("sid") or uuid.uuid4().hex
+    st.query_params["sid"] = st.session_state.session_id
+if 'messages' not in st.session_state:
+    st.session_state.messages = collections.deque(maxlen=MAX_MESSAGES)
+
+API_KEY = get_api_key()
 
-if not st.session_state.api_configured and not st.session_state.attempted_initial_config:
+# Configure once per key, so entering a different key in the sidebar reconfigures the API.
+if st.session_state.get('configured_key') != API_KEY:
     if API_KEY:
         if configure_api(API_KEY):
             st.session_state.api_configured = True
             
             if "gemini_model" in st.session_state: del st.session_state.gemini_model
             if "chat_session" in st.session_state: del st.session_state.chat_session
-            if "messages" in st.session_state: st.session_state.messages = []
+            st.session_state.messages.clear()
         else:
             st.session_state.api_configured = False 
     else:
         st.session_state.api_configured = False 
-    st.session_state.attempted_initial_config = True
+    st.session_state.configured_key = API_KEY
 
 
 # --- Streamlit UI ---
@@ -82,25 +207,26 @@ with st.sidebar:
     st.header("Configuration Status")
     if not API_KEY:
         st.error(
-            "🔴 `GOOGLE_API_KEY` not found in `fun_load2.env`. "
-            "Please create/update the file with your key and restart the app."
+            "🔴 `GOOGLE_API_KEY` not found in Streamlit secrets or the environment. "
+            "Please enter your key above."
         )
     elif st.session_state.get('api_configured'):
         st.success("✅ API Key configured successfully!")
     else:
         st.error(
-            "🔴 Failed to configure API with the key from `fun_load2.env`. "
-            "Please check the key, your Google AI Studio project settings, and then restart the app."
+            "🔴 Failed to configure API with the provided `GOOGLE_API_KEY`. "
+            "Please check the key and your Google AI Studio project settings."
         )
 
     if st.session_state.get('api_configured', False):
         st.markdown("---")
         st.subheader("Chat Settings")
         if st.button("Clear Chat History", key="clear_chat_main"):
-            st.session_state.messages = []
+            # The sidebar runs before the chat body, so this same run renders the cleared chat.
+            st.session_state.messages.clear()
             if "chat_session" in st.session_state:
-                del st.session_state.chat_session
-            st.rerun()
+                with st.session_state.chat_lock:
+                    st.session_state.chat_session.history = []
     else:
         st.warning("API not configured. Chat functionality is disabled.")
 
@@ -111,29 +237,34 @@ with st.sidebar:
 # --- Main Chat Logic ---
 if not st.session_state.get('api_configured', False):
     st.info(
-        "API not configured. Please ensure `GOOGLE_API_KEY` is correctly set in your "
-        "`fun_load2.env` file and restart the Streamlit application."
+        "API not configured. Please set `GOOGLE_API_KEY` in Streamlit secrets or the "
+        "environment, or enter it in the sidebar."
     )
 else:
     if "gemini_model" not in st.session_state:
-        st.session_state.gemini_model = initialize_gemini_model()
+        st.session_state.gemini_model = initialize_gemini_model(API_KEY)
 
     if not st.session_state.gemini_model:
         st.error(
             "Model could not be initialized. This might be due to an issue with the API key "
-            "in `fun_load2.env` or network problems. Please verify and restart."
+            "or network problems. Please verify and restart."
         )
         st.stop()
 
     if "chat_session" not in st.session_state:
         try:
-            st.session_state.chat_session = st.session_state.gemini_model.start_chat(history=[])
+            st.session_state.chat_session, st.session_state.chat_lock = get_chat_session(st.session_state.session_id, API_KEY)
         except Exception as e:
-            st.error(f"Failed to start chat session: {e}. This could be an API key or network issue. Please check `fun_load2.env` and restart.")
+            st.error(f"Failed to start chat session: {e}. This could be an API key or network issue. Please check your API key.")
             st.stop()
 
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+    if not st.session_state.messages:
+        # After a reload the cached chat may already have turns; show them again.
+        with st.session_state.chat_lock:
+            st.session_state.messages.extend(
+                {"role": content.role, "content": content_text(content)}
+                for content in read_chat_history(st.session_state.chat_session)
+            )
 
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
@@ -144,60 +275,108 @@ else:
         with st.chat_message("user"):
             st.markdown(user_prompt)
 
-        if "chat_session" not in st.session_state:
-            st.error("Chat session not available. Please ensure the API key in `fun_load2.env` is correct and restart.")
-            st.stop()
+        # Held until the reply is committed or rolled back, so another tab on this chat waits its turn.
+        with st.session_state.chat_lock:
+            chat_session = st.session_state.chat_session
+            # Kept so a reply that fails, stops early or is interrupted can be dropped from the chat again.
+            committed_history = list(read_chat_history(chat_session))
+            try:
+                # The spinner only covers the wait for the first chunk; after that tokens render as they arrive.
+                with st.spinner("Gemini is thinking..."):
+                    response = run_async(chat_session.send_message_async(user_prompt, stream=True))
 
-        try:
-            with st.spinner("Gemini is thinking..."):
-                response = st.session_state.chat_session.send_message(user_prompt)
-
-            if response.parts:
-                gemini_response_content = "".join(part.text for part in response.parts)
-            elif response.prompt_feedback and response.prompt_feedback.block_reason:
-                gemini_response_content = f"Response blocked due to: {response.prompt_feedback.block_reason_message or response.prompt_feedback.block_reason.name}. Please rephrase your prompt."
-                st.warning(gemini_response_content)
-            else:
-                if not response.candidates or not response.candidates[0].content.parts:
-                     gemini_response_content = "Sorry, I received an empty response from the model. Please try again or rephrase."
-                else:
-                     gemini_response_content = "Sorry, I didn't get a valid response. Please try again."
-                st.warning(gemini_response_content)
+                def token_iter():
+                    # Coalesce bursts of chunks so the UI updates at most once per frame.
+                    # NOTE: never add time.sleep() here to "smooth" the output. Gemini's own chunk
+                    # cadence is fast enough, and per-token sleeps only add latency; tune
+                    # STREAM_FLUSH_INTERVAL instead.
+                    buffer = []
+                    last_flush = time.perf_counter()
+                    for chunk in iter_async(response):
+                        try:
+                            buffer.append(chunk.text)
+                        except ValueError:
+                            # Nothing to show for chunks without a single text part.
+                            continue
+                        if time.perf_counter() - last_flush > STREAM_FLUSH_INTERVAL:
+                            yield "".join(buffer)
+                            buffer.clear()
+                            last_flush = time.perf_counter()
+                    if buffer:
+                        yield "".join(buffer)
 
+                with st.chat_message("model"):
+                    st.write_stream(token_iter())
 
-            st.session_state.messages.append({"role": "model", "content": gemini_response_content})
-            with st.chat_message("model"):
-                st.markdown(gemini_response_content)
+                    try:
+                        gemini_response_content = response.text
+                        finish_reason = response.candidates[0].finish_reason.name
+                    except ValueError:
+                        finish_reason = None
+                        # `response.text` raises when there is no candidate or no single text part (blocked or empty reply).
+                        # Each of these properties converts from protobuf on access, so read them once.
+                        prompt_feedback = response.prompt_feedback
+                        candidates = response.candidates
+                        if prompt_feedback and prompt_feedback.block_reason:
+                            gemini_response_content = f"Response blocked due to: {prompt_feedback.block_reason_message or prompt_feedback.block_reason.name}. Please rephrase your prompt."
+                        elif not candidates or not candidates[0].content.parts:
+                            gemini_response_content = "Sorry, I received an empty response from the model. Please try again or rephrase."
+                        else:
+                            gemini_response_content = "Sorry, I didn't get a valid response. Please try again."
+                        st.warning(gemini_response_content)
+                    else:
+                        # In stream mode the SDK does not raise for early stops; they only show up here.
+                        if finish_reason not in COMPLETE_FINISH_REASONS:
+                            gemini_response_content = f"Response generation stopped. Reason: {finish_reason}. Please rephrase your prompt."
+                            st.warning(gemini_response_content)
 
-        except Exception as e:
-            error_message = f"An error occurred: {e}"
-            st.error(error_message)
-            
-            api_key_related_error = False
-            if isinstance(e, genai.types.generation_types.BlockedPromptException):
-                gemini_response_content = f"Response blocked. Reason: {e}"
-            elif isinstance(e, genai.types.generation_types.StopCandidateException):
-                gemini_response_content = f"Response generation stopped. Reason: {e}"
-            elif "API_KEY" in str(e).upper() or "PERMISSION_DENIED" in str(e).upper() or "UNAUTHENTICATED" in str(e).upper():
-                st.error(
-                    "API Key issue detected (e.g., invalid, unauthenticated, or permission denied). "
-                    "Please verify `GOOGLE_API_KEY` in `fun_load2.env` and restart the app."
-                )
-                st.session_state.api_configured = False
-                if "gemini_model" in st.session_state: del st.session_state.gemini_model
-                if "chat_session" in st.session_state: del st.session_state.chat_session
-                gemini_response_content = f"Critical API Error. Please check logs and .env file. Error: {str(e)[:100]}..."
-                api_key_related_error = True 
-            elif "RESOURCE_EXHAUSTED" in str(e).upper():
-                 st.error("Quota possibly exceeded. Check your Google Cloud Console or AI Studio billing and quotas.")
-                 gemini_response_content = f"Error: Resource exhausted. {str(e)[:100]}..."
-            else:
-                gemini_response_content = f"Sorry, an unexpected error occurred: {str(e)[:100]}..."
-
-            if not api_key_related_error: 
                 st.session_state.messages.append({"role": "model", "content": gemini_response_content})
-                with st.chat_message("model"):
-                    st.markdown(gemini_response_content)
+
+                if finish_reason in COMPLETE_FINISH_REASONS:
+                    # Reading the history commits the finished reply to the chat.
+                    history = chat_session.history
+                    if len(history) > MAX_HISTORY:
+                        chat_session.history = history[-MAX_HISTORY:]
+
+            except Exception as e:
+                error_text = str(e)
+                short_error_text = error_text[:100]
+                error_message = f"An error occurred: {error_text}"
+                st.error(error_message)
             
-            if api_key_related_error:
-                st.rerun()
+                from google.generativeai.types import generation_types
+
+                api_key_related_error = False
+                # Collect every match so auth errors win over quota ones wherever they appear.
+                error_kinds = {match.lastgroup for match in API_ERROR_PATTERN.finditer(error_text)}
+                if isinstance(e, generation_types.BlockedPromptException):
+                    gemini_response_content = f"Response blocked. Reason: {error_text}"
+                elif "auth" in error_kinds:
+                    st.error(
+                        "API Key issue detected (e.g., invalid, unauthenticated, or permission denied). "
+                        "Please verify `GOOGLE_API_KEY`."
+                    )
+                    st.session_state.api_configured = False
+                    if "gemini_model" in st.session_state: del st.session_state.gemini_model
+                    if "chat_session" in st.session_state: del st.session_state.chat_session
+                    gemini_response_content = f"Critical API Error. Please check logs and your API key. Error: {short_error_text}..."
+                    api_key_related_error = True 
+                elif "quota" in error_kinds:
+                     st.error("Quota possibly exceeded. Check your Google Cloud Console or AI Studio billing and quotas.")
+                     gemini_response_content = f"Error: Resource exhausted. {short_error_text}..."
+                else:
+                    gemini_response_content = f"Sorry, an unexpected error occurred: {short_error_text}..."
+
+                if not api_key_related_error: 
+                    st.session_state.messages.append({"role": "model", "content": gemini_response_content})
+                    with st.chat_message("model"):
+                        st.markdown(gemini_response_content)
+            
+                if api_key_related_error:
+                    st.rerun()
+
+            finally:
+                # An uncommitted reply (failed, stopped early, or cut off by a rerun) makes
+                # `chat_session.history` raise and every later message fail, so restore the history as it was.
+                if chat_session.last is not None:
+                    chat_session.history = committed_history